@@ -1,26 +1,84 @@
-import time
+import asyncio
+import contextlib
+import logging
+import random
+import signal
+from logging.handlers import TimedRotatingFileHandler
 
-import schedule
-from loguru import logger
+import requests
 
 from utils.config import config
 from utils.teams import Teams
 
-EMAIL = config.get("ALWAYSGREEN_EMAIL", False)
-PASSWORD = config.get("ALWAYSGREEN_PASSWORD", False)
+EMAIL = config.get("ALWAYSGREEN_EMAIL")
+PASSWORD = config.get("ALWAYSGREEN_PASSWORD")
+INTERVAL = 90
+INTERVAL_JITTER = 15
+MAX_INTERVAL = 600
 
+TEAMS = Teams(email=EMAIL, password=PASSWORD)
 
-def set_teams_activity():
-    teams = Teams(email=EMAIL, password=PASSWORD)
-    set_activity = teams.set_activity(activity="Available", availability="Available")
-    logger.info("Activity updated.")
 
+def set_teams_activity() -> int | None:
+    try:
+        updated = TEAMS.set_activity(activity="Available", availability="Available")
+    except requests.RequestException as error:
+        logger.warning("Activity update failed: %s", error)
+        return 0
 
-logger.add("app.log", rotation="1 day")
+    if updated:
+        logger.info("Activity updated.")
+    else:
+        logger.warning("Activity update failed.")
 
-set_teams_activity()
-schedule.every(90).seconds.do(set_teams_activity)
+    return TEAMS.retry_after
 
-while True:
-    schedule.run_pending()
-    time.sleep(1)
+
+async def wait(event: asyncio.Event, timeout: float) -> None:
+    with contextlib.suppress(asyncio.TimeoutError):
+        await asyncio.wait_for(event.wait(), timeout)
+
+
+async def main():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    def request_stop(sig: signal.Signals) -> None:
+        # A second signal falls through to the default handler.
+        loop.remove_signal_handler(sig)
+        stop.set()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, request_stop, sig)
+
+    interval = INTERVAL
+    while not stop.is_set():
+        started = loop.time()
+        retry_after = await asyncio.to_thread(set_teams_activity)
+
+        if retry_after is None:
+            interval = INTERVAL
+        else:
+            interval = min(interval * 2, MAX_INTERVAL)
+
+        delay = interval + random.uniform(-INTERVAL_JITTER, INTERVAL_JITTER)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        await wait(stop, delay - (loop.time() - started))
+
+    logger.info("Stopped.")
+
+
+logger = logging.getLogger("alwaysgreen")
+logger.setLevel(logging.INFO)
+
+formatter = logging.Formatter("%(asctime)s | %(levelname)s | %(message)s")
+for handler in (
+    logging.StreamHandler(),
+    TimedRotatingFileHandler("app.log", when="midnight"),
+):
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+asyncio.run(main())
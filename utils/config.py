@@ -1,12 +1,11 @@
 import utils.yaml as yaml
-from utils.singleton import Singleton
 
 
-class Config(metaclass=Singleton):
+class Config:
     def __init__(self) -> None:
         self.yaml = yaml.read(".env")
 
-    def get(self, key: str, default=False) -> str | bool:
+    def get(self, key: str, default=None) -> str | None:
         return self.yaml.get(key, default)
 
 
@@ -1,10 +1,93 @@
+import base64
+import functools
+import json
+import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from msal import PublicClientApplication
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger("alwaysgreen.teams")
+
+REQUEST_TIMEOUT = 10
+TOKEN_EXPIRY_MARGIN = 300
+SKYPE_TOKEN_DEFAULT_TTL = 3600
+
+AUTHENTICATION_METADATA = {
+    1: {
+        "scope": "openid offline_access profile service::api.fl.spaces.skype.com::MBI_SSL",
+        "client_id": "8ec6bc83-69c8-4392-8f08-b3c986009232",
+        "tenant": "9188040d-6c67-4c5b-b112-36a304b66dad",
+    },
+    2: {
+        "scope": "https://api.spaces.skype.com/.default",
+        "client_id": "1fec8e78-bce4-4aaf-ab1b-5451cc387264",
+    },
+}
+
+PRESENCE_DOMAINS = {
+    1: "presence.teams.live.com",
+    2: "presence.teams.microsoft.com",
+}
+
+
+def token_expiry(token: str) -> int:
+    """
+    Get the expiry timestamp of a token from its JWT `exp` claim.
+
+    :param token: Token to inspect.
+    :return: Expiry timestamp, or now plus a default TTL if the token is not a JWT.
+    """
+
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+        return int(claims["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return int(time.time()) + SKYPE_TOKEN_DEFAULT_TTL
+
+
+@functools.lru_cache
+def presence_body(activity: str, availability: str) -> bytes:
+    """
+    Get the serialized body of a presence update request.
+
+    :param activity: User's activity.
+    :param availability: User's availability.
+    :return: JSON-encoded request body.
+    """
+
+    return json.dumps(
+        {
+            "activity": activity,
+            "availability": availability,
+            "deviceType": "Mobile",
+        }
+    ).encode()
 
 
 class Teams:
+    __slots__ = (
+        "email",
+        "password",
+        "session",
+        "account_type_cache",
+        "tenant_id_cache",
+        "presence_url_cache",
+        "client_cache",
+        "silent_token_cache",
+        "skype_token_cache",
+        "retry_after",
+        "need_login",
+        "access_token",
+        "refresh_token",
+        "access_token_expiry",
+    )
+
     def __init__(self, email: str, password: str) -> None:
         """
         Initialize a Teams object.
@@ -16,60 +99,99 @@ class Teams:
         self.email = email
         self.password = password
         self.session = requests.Session()
+        self.session.headers["User-Agent"] = "okhttp/4.9.2"
+        self.session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=4,
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=0.3,
+                    status_forcelist=[502, 503, 504],
+                    raise_on_status=False,
+                    respect_retry_after_header=False,
+                ),
+            ),
+        )
         self.account_type_cache = None
+        self.tenant_id_cache = None
+        self.presence_url_cache = None
         self.client_cache = None
         self.silent_token_cache = None
+        self.skype_token_cache = None
+        self.retry_after = None
         self.need_login = True
         self.access_token = None
         self.refresh_token = None
         self.access_token_expiry = None
 
     @property
-    def account_type(self) -> int | bool:
+    def account_type(self) -> int | None:
         """
         Get the account type of the user.
 
-        :return: Account type (1 for MSAccount, 2 for OrgId), or False if unknown.
+        :return: Account type (1 for MSAccount, 2 for OrgId), or None if unknown.
         """
 
-        if self.account_type_cache:
+        if self.account_type_cache is not None:
             return self.account_type_cache
 
         account_type = self.session.get(
-            f"https://odc.officeapps.live.com/odc/v2.1/idp?hm=10&emailAddress={self.email}&forcerefresh=true"
+            f"https://odc.officeapps.live.com/odc/v2.1/idp?hm=10&emailAddress={self.email}&forcerefresh=true",
+            timeout=REQUEST_TIMEOUT,
         )
 
         if account_type.ok:
             if account_type := account_type.json():
-                if account_type := account_type.get("account", False):
+                if account_type := account_type.get("account"):
                     if account_type == "MSAccount":
                         self.account_type_cache = 1
                     elif "OrgId" in account_type:
                         self.account_type_cache = 2
 
-                    return self.account_type_cache
-
-        return False
+        return self.account_type_cache
 
     @property
-    def tenant_id(self) -> str | bool:
+    def tenant_id(self) -> str | None:
         """
         Get the tenant ID associated with the user's email domain.
 
-        :return: Tenant ID or False if not found.
+        :return: Tenant ID or None if not found.
         """
 
+        if self.tenant_id_cache is not None:
+            return self.tenant_id_cache
+
         if "@" in self.email:
             domain = self.email.split("@")[-1]
             well_known_response = self.session.get(
-                f"https://odc.officeapps.live.com/odc/v2.1/federationprovider?domain={domain}"
+                f"https://odc.officeapps.live.com/odc/v2.1/federationprovider?domain={domain}",
+                timeout=REQUEST_TIMEOUT,
             )
 
             if well_known_response.ok:
                 well_known_data = well_known_response.json()
-                return well_known_data.get("tenantId", False)
+                self.tenant_id_cache = well_known_data.get("tenantId")
 
-        return False
+        return self.tenant_id_cache
+
+    def bootstrap(self) -> None:
+        """
+        Resolve the account type and tenant ID concurrently ahead of the first login.
+        """
+
+        if self.account_type_cache is not None or self.tenant_id_cache is not None:
+            return
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [
+                executor.submit(getattr, self, "account_type"),
+                executor.submit(getattr, self, "tenant_id"),
+            ]
+
+        for future in futures:
+            future.result()
 
     @property
     def authentication_metadata(self) -> dict:
@@ -79,53 +201,66 @@ class Teams:
         :return: Authentication metadata dictionary.
         """
 
-        match self.account_type:
-            case 1:
-                return {
-                    "scope": "openid offline_access profile service::api.fl.spaces.skype.com::MBI_SSL",
-                    "client_id": "8ec6bc83-69c8-4392-8f08-b3c986009232",
-                    "tenant": "9188040d-6c67-4c5b-b112-36a304b66dad",
-                }
-            case 2:
-                return {
-                    "scope": "https://api.spaces.skype.com/.default",
-                    "client_id": "1fec8e78-bce4-4aaf-ab1b-5451cc387264",
-                    "tenant": self.tenant_id,
-                }
-            case _:
+        account_type = self.account_type
+        if account_type not in AUTHENTICATION_METADATA:
+            return {}
+
+        if account_type == 2:
+            if (tenant_id := self.tenant_id) is None:
                 return {}
 
+            return AUTHENTICATION_METADATA[2] | {"tenant": tenant_id}
+
+        return AUTHENTICATION_METADATA[account_type]
+
     @property
-    def client(self) -> bool | tuple:
+    def presence_url(self) -> str | None:
+        """
+        Get the presence update URL for the user's account type.
+
+        :return: Presence URL, or None if the account type is unknown.
+        """
+
+        if self.presence_url_cache is not None:
+            return self.presence_url_cache
+
+        if (domaine := PRESENCE_DOMAINS.get(self.account_type)) is not None:
+            self.presence_url_cache = f"https://{domaine}/v1/me/forceavailability"
+
+        return self.presence_url_cache
+
+    @property
+    def client(self) -> tuple | None:
         """
         Get the PublicClientApplication instance for authentication.
 
         :return: Tuple containing authentication metadata and PublicClientApplication instance,
-                 or False if client cannot be initialized.
+                 or None if client cannot be initialized.
         """
 
-        if self.client_cache:
+        if self.client_cache is not None:
             return self.client_cache
 
         if auth_metadata := self.authentication_metadata:
             self.client_cache = auth_metadata, PublicClientApplication(
                 auth_metadata.get("client_id"),
                 authority=f"https://login.microsoftonline.com/{auth_metadata.get('tenant')}",
+                timeout=REQUEST_TIMEOUT,
             )
 
-            return self.client_cache
-
-        return False
+        return self.client_cache
 
     @property
     def is_token_expired(self) -> bool:
         """
-        Check if the access token has expired.
+        Check if the access token has expired or is about to expire.
 
         :return: True if the token has expired, False otherwise.
         """
 
-        return int(time.time()) < self.access_token_expiry
+        return (
+            int(time.time()) >= (self.access_token_expiry or 0) - TOKEN_EXPIRY_MARGIN
+        )
 
     def refresh_access_token(self) -> bool:
         """
@@ -134,63 +269,99 @@ class Teams:
         :return: True if the token was successfully refreshed, False otherwise.
         """
 
+        if self.client is None or self.refresh_token is None:
+            self.reset_login()
+            return False
+
         auth_metadata, client = self.client
-        if client and self.refresh_token:
-            if account := client.acquire_token_by_refresh_token(
-                self.refresh_token, scopes=[auth_metadata.get("scope")]
-            ):
-                self.set_account_data(account)
-                return True
+        account = client.acquire_token_by_refresh_token(
+            self.refresh_token, scopes=[auth_metadata.get("scope")]
+        )
+
+        if self.set_account_data(account):
+            return True
+
+        # Other errors may be transient, so keep the refresh token and retry later.
+        if account is not None and account.get("error") == "invalid_grant":
+            self.reset_login()
 
         return False
 
-    def set_account_data(self, account: dict) -> None:
+    def reset_login(self) -> None:
+        """
+        Forget the current tokens so that the next access token request logs in again.
+        """
+
+        self.need_login = True
+        self.access_token = None
+        self.refresh_token = None
+        self.access_token_expiry = None
+        self.silent_token_cache = None
+        self.skype_token_cache = None
+
+    def set_account_data(self, account: dict | None) -> bool:
         """
         Set account data after successful authentication.
 
         :param account: Account data dictionary.
+        :return: True if the account data holds an access token, False otherwise.
         """
 
+        if account is None or account.get("access_token") is None:
+            return False
+
         self.need_login = False
-        self.access_token = account.get("access_token", False)
-        self.refresh_token = account.get("refresh_token", False)
+        self.access_token = account.get("access_token")
+        self.refresh_token = account.get("refresh_token", self.refresh_token)
         self.access_token_expiry = int(time.time()) + account.get("expires_in", 0)
+        return True
 
-    def logon_with_credentials(self) -> str | bool:
+    def logon_with_credentials(self) -> str | None:
         """
         Authenticate the user using username and password.
 
-        :return: Access token if authentication is successful, False otherwise.
+        :return: Access token if authentication is successful, None otherwise.
         """
 
+        if self.client is None:
+            return None
+
         auth_metadata, client = self.client
-        if client:
-            if account := client.acquire_token_by_username_password(
-                self.email, self.password, scopes=[auth_metadata.get("scope")]
-            ):
-                self.set_account_data(account)
-                return self.access_token
+        account = client.acquire_token_by_username_password(
+            self.email, self.password, scopes=[auth_metadata.get("scope")]
+        )
 
-        return False
+        if self.set_account_data(account):
+            return self.access_token
 
-    def logon_with_devicecode(self) -> str | bool:
+        return None
+
+    def logon_with_devicecode(self) -> str | None:
         """
         Authenticate the user using device code flow.
 
-        :return: Access token if authentication is successful, False otherwise.
+        :return: Access token if authentication is successful, None otherwise.
         """
 
+        if self.client is None:
+            return None
+
         auth_metadata, client = self.client
-        if client:
-            if flow := client.initiate_device_flow(scopes=[auth_metadata.get("scope")]):
-                if "message" in flow:
-                    print(flow.get("message"))
+        flow = client.initiate_device_flow(scopes=[auth_metadata.get("scope")])
+        if "user_code" not in flow:
+            logger.error(
+                "Device code flow could not be started: %s",
+                flow.get("error_description"),
+            )
+            return None
 
-                if account := client.acquire_token_by_device_flow(flow):
-                    self.set_account_data(account)
-                    return self.access_token
+        print(flow.get("message"))
 
-        return False
+        account = client.acquire_token_by_device_flow(flow)
+        if self.set_account_data(account):
+            return self.access_token
+
+        return None
 
     def set_activity(self, activity: str, availability: str) -> bool:
         """
@@ -201,46 +372,64 @@ class Teams:
         :return: True if activity is successfully set, False otherwise.
         """
 
+        self.retry_after = None
+        if self.need_login:
+            self.bootstrap()
+
+        if (presence_url := self.presence_url) is None:
+            return False
+
+        if (access_token := self.get_access_token()) is None:
+            return False
+
         headers = {
-            "authorization": f"Bearer {self.get_access_token()}",
+            "authorization": f"Bearer {access_token}",
+            "content-type": "application/json",
         }
 
         if self.account_type == 1:
             headers["x-ms-client-consumer-type"] = "teams4life"
             headers["x-skypetoken"] = self.x_skypetoken
-            domaine = "presence.teams.live.com"
-
-        if self.account_type == 2:
-            domaine = "presence.teams.microsoft.com"
 
         activity_request = self.session.put(
-            f"https://{domaine}/v1/me/forceavailability",
+            presence_url,
             headers=headers,
-            json={
-                "activity": activity,
-                "availability": availability,
-                "deviceType": "Mobile",
-            },
+            data=presence_body(activity, availability),
+            timeout=REQUEST_TIMEOUT,
         )
 
         if activity_request.ok:
             return True
 
+        if activity_request.status_code == 401:
+            self.access_token_expiry = 0
+            self.silent_token_cache = None
+            self.skype_token_cache = None
+
+        if activity_request.status_code == 429 or activity_request.status_code >= 500:
+            retry_after = activity_request.headers.get("Retry-After", "")
+            self.retry_after = int(retry_after) if retry_after.isdigit() else 0
+
         return False
 
     @property
-    def silent_token(self) -> str | bool:
+    def silent_token(self) -> str | None:
         """
         Get the silent token for authentication.
 
-        :return: Silent token or False if silent token cannot be acquired.
+        :return: Silent token or None if silent token cannot be acquired.
         """
 
-        if self.silent_token_cache:
+        if self.silent_token_cache is not None:
             return self.silent_token_cache
 
+        if self.client is None:
+            return None
+
         _, client = self.client
-        accounts = client.get_accounts()
+        if not (accounts := client.get_accounts()):
+            return None
+
         silent_token = client.acquire_token_silent(
             scopes=[
                 "openid offline_access profile service::api.fl.spaces.skype.com::MBI_SSL"
@@ -248,54 +437,68 @@ class Teams:
             account=accounts[0],
         )
 
-        self.silent_token_cache = silent_token.get("access_token", False)
+        if silent_token is not None:
+            self.silent_token_cache = silent_token.get("access_token")
+
         return self.silent_token_cache
 
     @property
     def x_skypetoken(self) -> str | None:
         """
-        Get the x-skypetoken for authentication.
+        Get the x-skypetoken for authentication, reusing it until it is about to expire.
 
         :return: x-skypetoken or None if it cannot be obtained.
         """
 
+        if self.skype_token_cache is not None:
+            skype_token, expiry = self.skype_token_cache
+            if int(time.time()) < expiry - TOKEN_EXPIRY_MARGIN:
+                return skype_token
+
+            self.skype_token_cache = None
+            self.silent_token_cache = None
+
         api_url = "https://authsvc.teams.microsoft.com/v1.0/authz"
         token = self.get_access_token()
         if self.account_type == 1:
             api_url = "https://teams.live.com/api/auth/v1.0/authz/consumer"
             token = self.silent_token
 
-        if token:
+        if token is not None and self.client is not None:
             auth_metadata, _ = self.client
 
             headers = {
-                "authorization": f"Bearer {self.silent_token}",
+                "authorization": f"Bearer {token}",
                 "ms-teams-authz-type": "ExplicitLogin",
                 "tenantid": auth_metadata.get("tenant"),
-                "user-agent": "okhttp/4.9.2",
                 "username": self.email,
             }
-            consumer_request = requests.post(api_url, headers=headers)
+            consumer_request = self.session.post(
+                api_url, headers=headers, timeout=REQUEST_TIMEOUT
+            )
 
             if consumer_request.ok:
                 consumer = consumer_request.json()
-                if "skypeToken" in consumer and "skypetoken" in consumer.get(
-                    "skypeToken"
-                ):
-                    return consumer.get("skypeToken").get("skypetoken")
+                skype_token = (consumer.get("skypeToken") or {}).get(
+                    "skypetoken"
+                ) or (consumer.get("tokens") or {}).get("skypeToken")
 
-                if "tokens" in consumer and "skypeToken" in consumer.get("tokens"):
-                    return consumer.get("tokens").get("skypeToken")
+                if skype_token:
+                    self.skype_token_cache = skype_token, token_expiry(skype_token)
+                    return skype_token
 
         return None
 
-    def get_access_token(self) -> str:
+    def get_access_token(self) -> str | None:
         """
         Get the access token for making API requests.
 
-        :return: Access token.
+        :return: Access token, or None if the user could not be authenticated.
         """
 
+        if not self.need_login and self.is_token_expired:
+            self.refresh_access_token()
+
         if self.need_login:
             if self.account_type == 1:
                 self.logon_with_devicecode()
@@ -303,7 +506,4 @@ class Teams:
             if self.account_type == 2:
                 self.logon_with_credentials()
 
-        if not self.is_token_expired:
-            self.refresh_access_token()
-
         return self.access_token
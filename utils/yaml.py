@@ -1,8 +1,13 @@
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 
 def read(path: str) -> None | dict:
     """Parses a yaml file to return it as a dict if it has content, None otherwise."""
 
     with open(path) as file:
-        return yaml.safe_load(file)
+        return yaml.load(file, Loader=SafeLoader)